@@ -41,7 +41,8 @@ requirements = {
         "pytest-runner",
     ],
     "test": [
-        "pytest>=3.3.0",
+        "pytest>=3.6.0",
+        "pytest-xdist>=1.26.1",
         "hacking>=1.1.0",
         "flake8>=3.7.8",
         "flake8-docstrings>=1.3.1",
@@ -4,7 +4,12 @@
 # Copyright 2019 Tomoki Hayashi
 #  MIT License (https://opensource.org/licenses/MIT)
 
+import collections
+import copy
+import functools
+import json
 import logging
+import zlib
 
 import numpy as np
 import pytest
@@ -76,186 +81,208 @@ def make_melgan_discriminator_args(**kwargs):
     return defaults
 
 
-@pytest.mark.parametrize(
-    "dict_g, dict_d, dict_loss", [
-        ({}, {}, {}),
-        ({"kernel_size": 3}, {}, {}),
-        ({"channels": 1024}, {}, {}),
-        ({"stack_kernel_size": 5}, {}, {}),
-        ({"stack_kernel_size": 5, "stacks": 2}, {}, {}),
-        ({"upsample_scales": [4, 4, 4, 4]}, {}, {}),
-        ({"upsample_scales": [8, 8, 2, 2, 2]}, {}, {}),
-        ({"channels": 1024, "upsample_scales": [8, 8, 2, 2, 2, 2]}, {}, {}),
-        ({"pad": "ConstantPad1d", "pad_params": {"value": 0.0}}, {}, {}),
-        ({"nonlinear_activation": "ReLU", "nonlinear_activation_params": {}}, {}, {}),
-        ({"bias": False}, {}, {}),
-        ({"use_final_nonlinear_activation": False}, {}, {}),
-        ({"use_weight_norm": False}, {}, {}),
-        ({"use_causal_conv": True}, {}, {}),
-    ])
-def test_melgan_trainable(dict_g, dict_d, dict_loss):
-    # setup
-    batch_size = 4
-    batch_length = 4096
-    args_g = make_melgan_generator_args(**dict_g)
-    args_d = make_discriminator_args(**dict_d)
-    args_loss = make_mutli_reso_stft_loss_args(**dict_loss)
-    y = torch.randn(batch_size, 1, batch_length)
-    c = torch.randn(batch_size, args_g["in_channels"],
-                    batch_length // np.prod(
-                        args_g["upsample_scales"]))
-    model_g = MelGANGenerator(**args_g)
-    model_d = ParallelWaveGANDiscriminator(**args_d)
-    aux_criterion = MultiResolutionSTFTLoss(**args_loss)
-    optimizer_g = RAdam(model_g.parameters())
-    optimizer_d = RAdam(model_d.parameters())
+GENERATOR_CASES = [
+    {},
+    {"kernel_size": 3},
+    {"channels": 1024},
+    {"stack_kernel_size": 5},
+    {"stack_kernel_size": 5, "stacks": 2},
+    {"upsample_scales": [4, 4, 4, 4]},
+    {"upsample_scales": [8, 8, 2, 2, 2]},
+    {"channels": 1024, "upsample_scales": [8, 8, 2, 2, 2, 2]},
+    {"pad": "ConstantPad1d", "pad_params": {"value": 0.0}},
+    {"nonlinear_activation": "ReLU", "nonlinear_activation_params": {}},
+    {"bias": False},
+    {"use_final_nonlinear_activation": False},
+    {"use_weight_norm": False},
+    {"use_causal_conv": True},
+]
 
-    # check generator trainable
-    y_hat = model_g(c)
-    p_hat = model_d(y_hat)
-    y, y_hat, p_hat = y.squeeze(1), y_hat.squeeze(1), p_hat.squeeze(1)
-    adv_loss = F.mse_loss(p_hat, p_hat.new_ones(p_hat.size()))
-    sc_loss, mag_loss = aux_criterion(y_hat, y)
-    aux_loss = sc_loss + mag_loss
-    loss_g = adv_loss + aux_loss
-    optimizer_g.zero_grad()
-    loss_g.backward()
-    optimizer_g.step()
+MELGAN_DISCRIMINATOR_CASES = [
+    {},
+    {"scales": 4},
+    {"kernel_sizes": [7, 5]},
+    {"max_downsample_channels": 128},
+    {"downsample_scales": [4, 4]},
+    {"pad": "ConstantPad1d", "pad_params": {"value": 0.0}},
+    {"nonlinear_activation": "ReLU", "nonlinear_activation_params": {}},
+]
 
-    # check discriminator trainable
-    y, y_hat = y.unsqueeze(1), y_hat.unsqueeze(1).detach()
-    p = model_d(y)
-    p_hat = model_d(y_hat)
-    p, p_hat = p.squeeze(1), p_hat.squeeze(1)
-    loss_d = F.mse_loss(p, p.new_ones(p.size())) + F.mse_loss(p_hat, p_hat.new_zeros(p_hat.size()))
-    optimizer_d.zero_grad()
-    loss_d.backward()
-    optimizer_d.step()
+DISCRIMINATORS = {
+    "ParallelWaveGANDiscriminator": (ParallelWaveGANDiscriminator, make_discriminator_args),
+    "ResidualParallelWaveGANDiscriminator": (ResidualParallelWaveGANDiscriminator, make_residual_discriminator_args),
+    "MelGANMultiScaleDiscriminator": (MelGANMultiScaleDiscriminator, make_melgan_discriminator_args),
+}
 
+# test ids consist of the discriminator name and the index in the above case lists
+TRAINABLE_CASES = [
+    pytest.param(discriminator_type, dict_g, {}, id=f"{discriminator_type}-generator_case{idx}")
+    for discriminator_type in ["ParallelWaveGANDiscriminator", "ResidualParallelWaveGANDiscriminator"]
+    for idx, dict_g in enumerate(GENERATOR_CASES)
+] + [
+    pytest.param("MelGANMultiScaleDiscriminator", {}, dict_d,
+                 id=f"MelGANMultiScaleDiscriminator-discriminator_case{idx}")
+    for idx, dict_d in enumerate(MELGAN_DISCRIMINATOR_CASES)
+]
 
-@pytest.mark.parametrize(
-    "dict_g, dict_d, dict_loss", [
-        ({}, {}, {}),
-        ({"kernel_size": 3}, {}, {}),
-        ({"channels": 1024}, {}, {}),
-        ({"stack_kernel_size": 5}, {}, {}),
-        ({"stack_kernel_size": 5, "stacks": 2}, {}, {}),
-        ({"upsample_scales": [4, 4, 4, 4]}, {}, {}),
-        ({"upsample_scales": [8, 8, 2, 2, 2]}, {}, {}),
-        ({"channels": 1024, "upsample_scales": [8, 8, 2, 2, 2, 2]}, {}, {}),
-        ({"pad": "ConstantPad1d", "pad_params": {"value": 0.0}}, {}, {}),
-        ({"nonlinear_activation": "ReLU", "nonlinear_activation_params": {}}, {}, {}),
-        ({"bias": False}, {}, {}),
-        ({"use_final_nonlinear_activation": False}, {}, {}),
-        ({"use_weight_norm": False}, {}, {}),
-    ])
-def test_melgan_trainable_with_residual_discriminator(dict_g, dict_d, dict_loss):
+
+def mse_to(x, value):
+    # broadcast the scalar target instead of allocating a full-size target tensor
+    return (x - value).pow(2).mean()
+
+
+def freeze_args(args):
+    # convert args including lists and dicts into hashable key
+    return json.dumps(args, sort_keys=True)
+
+
+def make_module_key(module_class, args):
+    return (module_class.__name__, freeze_args(args))
+
+
+# number of the tests requesting each module, used to keep the initial state only for shared ones
+MODULE_REQUESTS = collections.Counter()
+for case in TRAINABLE_CASES:
+    discriminator_type, dict_g, dict_d = case.values
+    discriminator_class, make_args_d = DISCRIMINATORS[discriminator_type]
+    MODULE_REQUESTS[make_module_key(MelGANGenerator, make_melgan_generator_args(**dict_g))] += 1
+    MODULE_REQUESTS[make_module_key(discriminator_class, make_args_d(**dict_d))] += 1
+
+
+def make_seed(*args):
+    # tests must not rely on the global random state to be run in parallel with pytest-xdist,
+    # so seed them with their arguments. crc32 is used since hash of str differs for each process.
+    return zlib.crc32(freeze_args(args).encode("utf-8"))
+
+
+@functools.lru_cache(maxsize=None)
+def make_aux_criterion(frozen_args):
+    # loss module has no trainable parameters so a single instance can be shared
+    return MultiResolutionSTFTLoss(**json.loads(frozen_args))
+
+
+@functools.lru_cache(maxsize=None)
+def make_inputs(batch_size, in_channels, batch_frames, upsampling_factor):
+    # inputs are shared over the tests so they must not be modified in-place
+    torch.manual_seed(make_seed(batch_size, in_channels, batch_frames, upsampling_factor))
+    y = torch.randn(batch_size, 1, batch_frames * upsampling_factor)
+    c = torch.randn(batch_size, in_channels, batch_frames)
+    return y, c
+
+
+@pytest.fixture(scope="module", autouse=True)
+def single_thread():
+    # inputs in the tests are too small to benefit from multi-threading
+    # restore the original setting to avoid affecting the other test modules
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    yield
+    torch.set_num_threads(num_threads)
+
+
+@pytest.fixture(scope="module")
+def build_module():
+    # build each module only once per unique args and share it over the tests in this module
+    cache = {}
+
+    def _build_module(module_class, args):
+        key = make_module_key(module_class, args)
+        if key not in cache:
+            torch.manual_seed(make_seed(*key))
+            module = module_class(**args)
+            # keep the module and its initial state only if it will be requested again
+            if MODULE_REQUESTS[key] > 1:
+                cache[key] = (module, copy.deepcopy(module.state_dict()))
+            return module
+        module, state_dict = cache[key]
+
+        # restore initial parameters which are updated in the previous test
+        module.load_state_dict(state_dict)
+        module.zero_grad()
+        for param in module.parameters():
+            param.requires_grad_(True)
+
+        return module
+
+    return _build_module
+
+
+@pytest.mark.parametrize("discriminator_type, dict_g, dict_d", TRAINABLE_CASES)
+def test_melgan_trainable(discriminator_type, dict_g, dict_d, build_module):
     # setup
-    batch_size = 4
-    batch_length = 4096
+    batch_size = 1
+    batch_frames = 8  # minimum length to satisfy the paddings of the generator
+    discriminator_class, make_args_d = DISCRIMINATORS[discriminator_type]
     args_g = make_melgan_generator_args(**dict_g)
-    args_d = make_residual_discriminator_args(**dict_d)
-    args_loss = make_mutli_reso_stft_loss_args(**dict_loss)
-    y = torch.randn(batch_size, 1, batch_length)
-    c = torch.randn(batch_size, args_g["in_channels"],
-                    batch_length // np.prod(
-                        args_g["upsample_scales"]))
-    model_g = MelGANGenerator(**args_g)
-    model_d = ResidualParallelWaveGANDiscriminator(**args_d)
-    aux_criterion = MultiResolutionSTFTLoss(**args_loss)
+    args_d = make_args_d(**dict_d)
+    y, c = make_inputs(batch_size, args_g["in_channels"], batch_frames,
+                       int(np.prod(args_g["upsample_scales"])))
+    model_g = build_module(MelGANGenerator, args_g)
+    model_d = build_module(discriminator_class, args_d)
     optimizer_g = RAdam(model_g.parameters())
     optimizer_d = RAdam(model_d.parameters())
 
     # check generator trainable
+    for param in model_d.parameters():
+        param.requires_grad_(False)
     y_hat = model_g(c)
     p_hat = model_d(y_hat)
-    y, y_hat, p_hat = y.squeeze(1), y_hat.squeeze(1), p_hat.squeeze(1)
-    adv_loss = F.mse_loss(p_hat, p_hat.new_ones(p_hat.size()))
-    sc_loss, mag_loss = aux_criterion(y_hat, y)
-    aux_loss = sc_loss + mag_loss
-    loss_g = adv_loss + aux_loss
+    if isinstance(p_hat, list):
+        # multi-scale discriminator returns the outputs of all layers for each scale
+        args_loss = make_mutli_reso_stft_loss_args()
+        aux_criterion = make_aux_criterion(freeze_args(args_loss))
+        sc_loss, mag_loss = aux_criterion(y_hat.squeeze(1), y.squeeze(1))
+        aux_loss = sc_loss + mag_loss
+        # stack the losses of each output and reduce them at once instead of accumulation
+        adv_loss = torch.stack([mse_to(p_hat[i][-1], 1.0) for i in range(len(p_hat))]).mean()
+        with torch.no_grad():
+            p = model_d(y)
+        fm_loss = torch.stack([F.l1_loss(p_hat[i][j], p[i][j].detach())
+                               for i in range(len(p_hat)) for j in range(len(p_hat[i]) - 1)]).mean()
+        loss_g = adv_loss + aux_loss + fm_loss
+    else:
+        adv_loss = mse_to(p_hat, 1.0)
+        loss_g = adv_loss
     optimizer_g.zero_grad()
     loss_g.backward()
     optimizer_g.step()
 
     # check discriminator trainable
-    y, y_hat = y.unsqueeze(1), y_hat.unsqueeze(1).detach()
-    p = model_d(y)
-    p_hat = model_d(y_hat)
-    p, p_hat = p.squeeze(1), p_hat.squeeze(1)
-    loss_d = F.mse_loss(p, p.new_ones(p.size())) + F.mse_loss(p_hat, p_hat.new_zeros(p_hat.size()))
+    for param in model_d.parameters():
+        param.requires_grad_(True)
+    # calculate real and fake outputs with a single forward calculation
+    p_ = model_d(torch.cat([y, y_hat.detach()], dim=0))
+    if isinstance(p_, list):
+        # use only the last layer outputs of each scale
+        p, p_hat = zip(*[p_[i][-1].chunk(2, dim=0) for i in range(len(p_))])
+        real_loss = torch.stack([mse_to(p[i], 1.0) for i in range(len(p))]).mean()
+        fake_loss = torch.stack([mse_to(p_hat[i], 0.0) for i in range(len(p_hat))]).mean()
+        loss_d = real_loss + fake_loss
+    else:
+        p, p_hat = p_.chunk(2, dim=0)
+        loss_d = mse_to(p, 1.0) + mse_to(p_hat, 0.0)
     optimizer_d.zero_grad()
     loss_d.backward()
     optimizer_d.step()
 
 
-@pytest.mark.parametrize(
-    "dict_g, dict_d, dict_loss", [
-        ({}, {}, {}),
-        ({}, {"scales": 4}, {}),
-        ({}, {"kernel_sizes": [7, 5]}, {}),
-        ({}, {"max_downsample_channels": 128}, {}),
-        ({}, {"downsample_scales": [4, 4]}, {}),
-        ({}, {"pad": "ConstantPad1d", "pad_params": {"value": 0.0}}, {}),
-        ({}, {"nonlinear_activation": "ReLU", "nonlinear_activation_params": {}}, {}),
-    ])
-def test_melgan_trainable_with_melgan_discriminator(dict_g, dict_d, dict_loss):
-    # setup
-    batch_size = 4
+def test_multi_resolution_stft_loss():
+    batch_size = 1
     batch_length = 4096
-    args_g = make_melgan_generator_args(**dict_g)
-    args_d = make_melgan_discriminator_args(**dict_d)
-    args_loss = make_mutli_reso_stft_loss_args(**dict_loss)
-    y = torch.randn(batch_size, 1, batch_length)
-    c = torch.randn(batch_size, args_g["in_channels"],
-                    batch_length // np.prod(
-                        args_g["upsample_scales"]))
-    model_g = MelGANGenerator(**args_g)
-    model_d = MelGANMultiScaleDiscriminator(**args_d)
-    aux_criterion = MultiResolutionSTFTLoss(**args_loss)
-    optimizer_g = RAdam(model_g.parameters())
-    optimizer_d = RAdam(model_d.parameters())
+    args_loss = make_mutli_reso_stft_loss_args()
+    torch.manual_seed(make_seed(batch_size, batch_length, args_loss))
+    y = torch.randn(batch_size, batch_length)
+    y_hat = torch.randn(batch_size, batch_length, requires_grad=True)
+    aux_criterion = make_aux_criterion(freeze_args(args_loss))
 
-    # check generator trainable
-    y_hat = model_g(c)
-    p_hat = model_d(y_hat)
-    y, y_hat = y.squeeze(1), y_hat.squeeze(1)
+    # check gradient flows through the loss
     sc_loss, mag_loss = aux_criterion(y_hat, y)
     aux_loss = sc_loss + mag_loss
-    adv_loss = 0.0
-    for i in range(len(p_hat)):
-        adv_loss += F.mse_loss(
-            p_hat[i][-1], p_hat[i][-1].new_ones(p_hat[i][-1].size()))
-    adv_loss /= (i + 1)
-    with torch.no_grad():
-        p = model_d(y.unsqueeze(1))
-    fm_loss = 0.0
-    for i in range(len(p_hat)):
-        for j in range(len(p_hat[i]) - 1):
-            fm_loss += F.l1_loss(p_hat[i][j], p[i][j].detach())
-    fm_loss /= (i + 1) * j
-    loss_g = adv_loss + aux_loss + fm_loss
-    optimizer_g.zero_grad()
-    loss_g.backward()
-    optimizer_g.step()
-
-    # check discriminator trainable
-    y, y_hat = y.unsqueeze(1), y_hat.unsqueeze(1).detach()
-    p = model_d(y)
-    p_hat = model_d(y_hat)
-    real_loss = 0.0
-    fake_loss = 0.0
-    for i in range(len(p)):
-        real_loss += F.mse_loss(
-            p[i][-1], p[i][-1].new_ones(p[i][-1].size()))
-        fake_loss += F.mse_loss(
-            p_hat[i][-1], p_hat[i][-1].new_zeros(p_hat[i][-1].size()))
-    real_loss /= (i + 1)
-    fake_loss /= (i + 1)
-    loss_d = real_loss + fake_loss
-    optimizer_d.zero_grad()
-    loss_d.backward()
-    optimizer_d.step()
+    aux_loss.backward()
+    assert torch.isfinite(aux_loss).all()
+    assert y_hat.grad is not None
+    assert torch.isfinite(y_hat.grad).all()
+    assert y_hat.grad.abs().sum() > 0
 
 
 @pytest.mark.parametrize(